@@ -18,7 +18,7 @@ from trainer.dataset import PreprocessedDataset
 from trainer.config import TrainingConfig
 from trainer.models import print_trainable_parameters, load_models
 from trainer.loss import compute_diffusion_loss, compute_grad_norm, ConditioningRegularizer, compute_token_attention_loss
-from trainer.inference import render_images, get_conditioning_signals
+from trainer.inference import render_images, get_conditioning_signals, get_cached_conditioning_signals
 from trainer.preprocess import preprocess
 from trainer.utils.io import make_validation_img_grid
 from trainer.ti_cross_attn_loss import init_daam_loss, plot_token_attention_loss
@@ -32,7 +32,18 @@ from trainer.optimizer import (
 )
 
 def train(config: TrainingConfig):
-
+    # let cuDNN benchmark the (NHWC) conv algorithms, it autotunes once per input shape
+    # (one per aspect ratio bucket / validation render size). Only for this run, restore the host process's setting afterwards:
+    prev_cudnn_benchmark = torch.backends.cudnn.benchmark
+    torch.backends.cudnn.benchmark = True
+    try:
+        return _train(config)
+    finally:
+        torch.backends.cudnn.benchmark = prev_cudnn_benchmark
+
+def _train(config: TrainingConfig):
+
+    config.ensure_output_dir()
     seed_everything(config.seed)
     weight_dtype = dtype_map[config.weight_type]
 
@@ -104,6 +115,12 @@ def train(config: TrainingConfig):
 
     # Turn off all gradients for now:
     unet.requires_grad_(False)
+
+    # channels_last (NHWC) unlocks the tensor-core conv kernels in cuDNN, the latents are converted to match in the training loop.
+    # Done before the LoRA layers are injected: the (saved) trainable weights must stay contiguous, safetensors refuses to save anything else
+    # (which is also why full unet finetuning keeps the default layout)
+    memory_format = torch.channels_last if (torch.cuda.is_available() and config.is_lora) else torch.contiguous_format
+    unet.to(memory_format=memory_format)
     vae.requires_grad_(False)
     text_encoders = embedding_handler.text_encoders
     for txt_encoder in text_encoders:
@@ -119,7 +136,8 @@ def train(config: TrainingConfig):
             use_dora = config.use_dora,
             optimizer_name = config.text_encoder_lora_optimizer,
             lora_lr = config.text_encoder_lora_lr,
-            weight_decay = config.text_encoder_lora_weight_decay
+            weight_decay = config.text_encoder_lora_weight_decay,
+            use_8bit_optim = config.use_8bit_optim
         )
     else:
         optimizer_text_encoder_lora = None
@@ -127,12 +145,15 @@ def train(config: TrainingConfig):
 
 
     embedding_handler.make_embeddings_trainable()
-    if not config.disable_ti:
+    # Only build the TI optimizer (and its state tensors) when the token embeddings will actually be updated:
+    if not config.disable_ti and (config.ti_lr > 0.0 or config.ti_optimizer == "prodigy"):
         optimizer_ti, textual_inversion_params = get_textual_inversion_optimizer(
             text_encoders=text_encoders,
             textual_inversion_lr=config.ti_lr,
             textual_inversion_weight_decay=config.ti_weight_decay,
-            optimizer_name=config.ti_optimizer ## hardcoded
+            optimizer_name=config.ti_optimizer, ## hardcoded
+            freeze_text_encoders=config.text_encoder_lora_optimizer is None,
+            use_8bit_optim=config.use_8bit_optim
         )
     else:
         optimizer_ti = None
@@ -157,9 +178,29 @@ def train(config: TrainingConfig):
             lora_weight_decay=config.lora_weight_decay,
             use_dora = config.use_dora,
             unet=unet,
-            pipe=pipe
+            pipe=pipe,
+            use_rslora = config.use_rslora
         )
 
+    if config.gradient_checkpointing:
+        # Recompute the unet activations during backward: ~30% slower steps for a much smaller activation memory footprint
+        # (peft forwards this call to the wrapped diffusers unet, which checkpoints with use_reentrant=False)
+        unet.enable_gradient_checkpointing()
+        # diffusers only checkpoints in training mode and from_single_file() returns the unet in eval mode.
+        # Safe for training + sampling: the SD unets have no batchnorm and their dropout defaults to 0.0
+        unet.train()
+
+    # The training step calls unet_forward, unet itself stays the (uncompiled) peft model used for saving and sampling:
+    unet_forward = unet
+    use_cuda_graphs = False
+    if config.compile_unet and torch.cuda.is_available():
+        print("Compiling the unet with torch.compile...")
+        # Static shapes (fixed resolution and batch size) let reduce-overhead mode capture and replay the unet as CUDA graphs.
+        # The text encoders are left uncompiled to avoid recompiles on varying token lengths.
+        use_cuda_graphs = config.cuda_graphs
+        cudagraph_mark_step_begin = get_cudagraph_mark_step_begin()
+        unet_forward = torch.compile(unet, mode="reduce-overhead" if use_cuda_graphs else "default", dynamic=False)
+
     if config.unet_lr > 0.0:
         optimizer_unet = get_unet_optimizer(
             prodigy_d_coef=config.prodigy_d_coef,
@@ -196,18 +237,27 @@ def train(config: TrainingConfig):
     torch.cuda.empty_cache()
 
     print(f"# Trainer : Loaded dataset, do_cache: {config.do_cache}")
+    # Note: no pin_memory, the cached latents (and default masks) already live on the gpu and can't be pinned
+    dataloader_kwargs = {}
+    if config.dataloader_num_workers > 0:
+        # keep the workers alive across epochs and let them prefetch ahead:
+        dataloader_kwargs = {"persistent_workers": True, "prefetch_factor": 4}
+
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=config.train_batch_size,
         shuffle=True,
-        num_workers=config.dataloader_num_workers
+        num_workers=config.dataloader_num_workers,
+        **dataloader_kwargs
     )
 
-    config.num_train_epochs = int(math.ceil(config.max_train_steps / len(train_dataloader)))
+    # computed once, also reused by the per-step completion / last_batch bookkeeping:
+    num_batches_per_epoch = len(train_dataloader)
+    config.num_train_epochs = int(math.ceil(config.max_train_steps / num_batches_per_epoch))
     total_batch_size = config.train_batch_size * config.gradient_accumulation_steps
 
     print(f"--- Num samples = {len(train_dataset)}")
-    print(f"--- Num batches each epoch = {len(train_dataloader)}")
+    print(f"--- Num batches each epoch = {num_batches_per_epoch}")
     print(f"--- Num Epochs = {config.num_train_epochs}")
     print(f"--- Instantaneous batch size per device = {config.train_batch_size}")
     print(f"--- Total batch_size (distributed + accumulation) = {total_batch_size}")
@@ -217,7 +267,8 @@ def train(config: TrainingConfig):
     global_step = 0
     last_save_step = 0
 
-    progress_bar = tqdm(range(global_step, config.max_train_steps), position=0, leave=True)
+    # mininterval: redraw the bar at most once per second instead of on every step
+    progress_bar = tqdm(range(global_step, config.max_train_steps), position=0, leave=True, mininterval=1.0)
     checkpoint_dir = os.path.join(str(config.output_dir), "checkpoints")
     if os.path.exists(checkpoint_dir):
         shutil.rmtree(checkpoint_dir)
@@ -253,6 +304,25 @@ def train(config: TrainingConfig):
     if config.debug:
         embedding_handler.visualize_random_token_embeddings(os.path.join(config.output_dir, 'ti_embeddings'), n = 10)
 
+    # config values that are read every step, cached as locals for the training loop:
+    device, n_tokens = config.device, config.n_tokens
+    caption_dropout, tok_caption = config.caption_dropout, config.token_dict["TOK"]
+    noise_offset, l1_penalty = config.noise_offset, config.l1_penalty
+    unet_lora_numel = sum(p.numel() for p in unet_lora_parameters) if unet_lora_parameters else 0
+    gradient_accumulation_steps = config.gradient_accumulation_steps
+
+    # Mixed precision: bf16 needs no loss scaling, fp16 does (GradScaler only works on fp32 master weights):
+    use_autocast = config.mixed_precision != "no" and torch.cuda.is_available()
+    autocast_dtype = torch.bfloat16 if config.mixed_precision == "bf16" else torch.float16
+    # Text encoder outputs per caption, only used while the token embeddings and text encoders are frozen:
+    conditioning_cache = {}
+    # per-run (not module level, so nothing stays alive on the GPU after training) output buffers + add_time_ids:
+    conditioning_buffers, add_time_ids_cache = {}, {}
+    # noise / timesteps are refilled in place every step instead of allocating fresh tensors:
+    noise_buffer, timesteps_buffer = None, None
+    num_train_timesteps = noise_scheduler.config.num_train_timesteps
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=use_autocast and config.mixed_precision == "fp16" and config.weight_type == "fp32")
+
     for epoch in range(config.num_train_epochs):
         if config.aspect_ratio_bucketing:
             train_dataset.bucket_manager.start_epoch()
@@ -260,7 +330,7 @@ def train(config: TrainingConfig):
 
         for step, batch in enumerate(train_dataloader):
             progress_bar.update(1)
-            finegrained_epoch = epoch + step / len(train_dataloader)
+            finegrained_epoch = epoch + step / num_batches_per_epoch
             completion_f = finegrained_epoch / config.num_train_epochs
 
             # param_groups[1] goes from ti_lr to 0.0 over the course of training
@@ -269,7 +339,12 @@ def train(config: TrainingConfig):
                 optimizers['textual_inversion'].param_groups[0]['lr'] = config.ti_lr * (1 - completion_f) ** 1.7
                 # Apply freezing condition
                 if completion_f > config.freeze_ti_after_completion_f:
-                    optimizers['textual_inversion'].param_groups[0]['lr'] = 0.0
+                    # The token embeddings are done training: drop the TI optimizer (and its state) instead of stepping it with lr = 0
+                    print(f"\nFreezing the token embeddings at step {global_step}")
+                    optimizer_collection.release('textual_inversion')
+                    for embedding_tensor in textual_inversion_params:
+                        embedding_tensor.requires_grad_(False)
+                        embedding_tensor.grad = None
 
             if optimizers['text_encoders'] is not None:
                 optimizers['text_encoders'].param_groups[0]['lr'] = config.text_encoder_lora_lr * (1 - completion_f) ** 2.0
@@ -293,102 +368,117 @@ def train(config: TrainingConfig):
             else:
                 captions, vae_latent, mask = train_dataset.get_aspect_ratio_bucketed_batch()
 
-            mask = mask.to(config.device)
+            mask = mask.to(device, non_blocking=True)
 
             captions = list(captions)
-            if config.caption_dropout > 0.0:
+            if caption_dropout > 0.0:
                 for i in range(len(captions)):
-                    if np.random.rand() < config.caption_dropout:
-                        captions[i] = config.token_dict["TOK"]
-
-            prompt_embeds, pooled_prompt_embeds, add_time_ids = get_conditioning_signals(
-                config, pipe, captions
-            )
+                    if np.random.rand() < caption_dropout:
+                        captions[i] = tok_caption
+
+            # Once TI is disabled / frozen (lr == 0) and there's no text-encoder LoRA, the conditioning of a caption is constant:
+            ti_frozen = optimizers['textual_inversion'] is None or (config.ti_optimizer != "prodigy" and optimizers['textual_inversion'].param_groups[0]['lr'] == 0.0)
+            if ti_frozen and optimizers['text_encoders'] is None:
+                prompt_embeds, pooled_prompt_embeds, add_time_ids = get_cached_conditioning_signals(
+                    config, pipe, captions, conditioning_cache, conditioning_buffers
+                )
+            else:
+                prompt_embeds, pooled_prompt_embeds, add_time_ids = get_conditioning_signals(
+                    config, pipe, captions, add_time_ids_cache
+                )
             
-            # Sample noise that we'll add to the latents:
-            vae_latent = vae_latent.to(weight_dtype)
-            noise = torch.randn_like(vae_latent)
+            if use_cuda_graphs:
+                # each loop iteration is a new training step, graph outputs of the previous step can be overwritten:
+                cudagraph_mark_step_begin()
 
-            if config.noise_offset > 0.0:
+            # Sample noise that we'll add to the latents:
+            vae_latent = vae_latent.to(weight_dtype, memory_format=memory_format)
+            if noise_buffer is None or noise_buffer.shape != vae_latent.shape or noise_buffer.dtype != vae_latent.dtype:
+                # (re)allocate only when the batch shape changes (last batch of an epoch / aspect ratio buckets):
+                noise_buffer = torch.empty_like(vae_latent)
+                timesteps_buffer = torch.empty((vae_latent.shape[0],), dtype=torch.long, device=vae_latent.device)
+            noise = noise_buffer.normal_()
+
+            if noise_offset > 0.0:
                 # https://www.crosslabs.org//blog/diffusion-with-offset-noise
-                noise += config.noise_offset * torch.randn(
-                    (noise.shape[0], noise.shape[1], 1, 1), device=noise.device)
+                # scale + broadcast-add in a single in-place kernel (no temporary offset * randn tensor):
+                noise.add_(torch.randn(
+                    (noise.shape[0], noise.shape[1], 1, 1), device=noise.device, dtype=noise.dtype), alpha=noise_offset)
 
-            timesteps = torch.randint(
-                0,
-                noise_scheduler.config.num_train_timesteps,
-                (vae_latent.shape[0],),
-                device=vae_latent.device,
-            ).long()
+            timesteps = timesteps_buffer.random_(0, num_train_timesteps)
 
             noisy_latent = noise_scheduler.add_noise(vae_latent, noise, timesteps)
 
-            # Predict the noise residual
-            model_pred = unet(
-                noisy_latent,
-                timesteps,
-                encoder_hidden_states=prompt_embeds,
-                timestep_cond=None,
-                added_cond_kwargs={"text_embeds": pooled_prompt_embeds, "time_ids": add_time_ids},
-                return_dict=False,
-            )[0]
-
-            # Compute the loss:
-            loss = compute_diffusion_loss(config, model_pred, noise, noisy_latent, mask, noise_scheduler, timesteps)
-            losses['img_loss'].append(loss.item())
+            with torch.autocast(device_type="cuda", dtype=autocast_dtype, enabled=use_autocast):
+                # Predict the noise residual
+                model_pred = unet_forward(
+                    noisy_latent,
+                    timesteps,
+                    encoder_hidden_states=prompt_embeds,
+                    timestep_cond=None,
+                    added_cond_kwargs={"text_embeds": pooled_prompt_embeds, "time_ids": add_time_ids},
+                    return_dict=False,
+                )[0]
+
+                # Compute the loss:
+                loss = compute_diffusion_loss(config, model_pred, noise, noisy_latent, mask, noise_scheduler, timesteps)
+            losses['img_loss'].append(loss.detach())
 
             if not config.disable_ti:
                 token_attention_loss = compute_token_attention_loss(pipe, embedding_handler, captions, mask, daam_loss)
-                losses['token_attention_loss'].append(token_attention_loss.item())
+                losses['token_attention_loss'].append(token_attention_loss.detach())
                 loss = loss + config.token_attention_loss_w * token_attention_loss
 
             if config.training_attributes["gpt_description"] and config.debug:
                 concept_description_loss = embedding_handler.compute_target_prompt_loss(config.training_attributes["gpt_description"], prompt_embeds, pooled_prompt_embeds, config, pipe)
                 # Dont apply this loss, just plot it for now:
                 loss += 0.0 * concept_description_loss
-                losses['concept_description_loss'].append(concept_description_loss.item())
+                losses['concept_description_loss'].append(concept_description_loss.detach())
 
-            if config.l1_penalty > 0.0 and unet_lora_parameters:
-                # Compute normalized L1 norm (mean of abs sum) of all lora parameters:
-                l1_norm = sum(p.abs().sum() for p in unet_lora_parameters) / sum(p.numel() for p in unet_lora_parameters)
-                loss += config.l1_penalty * l1_norm
+            if l1_penalty > 0.0 and unet_lora_parameters:
+                # Compute normalized L1 norm (mean of abs sum) of all lora parameters (single foreach kernel, constant denominator):
+                l1_norm = torch.stack(torch._foreach_norm(unet_lora_parameters, 1)).sum() / unet_lora_numel
+                loss += l1_penalty * l1_norm
 
             if optimizers['textual_inversion'] is not None and optimizers['textual_inversion'].param_groups[0]['lr'] > 0.0:
                 loss, losses, prompt_embeds_norms = embedding_handler.token_regularizer.apply_regularization(loss, losses, prompt_embeds_norms, prompt_embeds, pipe = pipe)
 
-            losses['tot_loss'].append(loss.item())
-            loss = loss / config.gradient_accumulation_steps
-            loss.backward()
+            losses['tot_loss'].append(loss.detach())
+            loss = loss / gradient_accumulation_steps
+            grad_scaler.scale(loss).backward()
 
-            last_batch = (step + 1 == len(train_dataloader))
-            if (step + 1) % config.gradient_accumulation_steps == 0 or last_batch:
+            last_batch = (step + 1 == num_batches_per_epoch)
+            if (step + 1) % gradient_accumulation_steps == 0 or last_batch:
 
                 if optimizers['textual_inversion'] is not None:
                     # zero out the gradients of the non-trained text-encoder embeddings
                     for i, embedding_tensor in enumerate(textual_inversion_params):
-                        embedding_tensor.grad.data[:-config.n_tokens, : ] *= 0.
+                        if embedding_tensor.grad is not None: # no grads once the conditioning comes from the cache
+                            embedding_tensor.grad.data[:-n_tokens, : ] *= 0.
 
                 if config.debug:
-                    # Track the average gradient norms:
+                    # Track the average gradient norms (of the unscaled grads when fp16 loss scaling is on):
+                    optimizer_collection.unscale_(grad_scaler)
                     grad_norms['unet'].append(compute_grad_norm(itertools.chain(unet.parameters())).item())
                     for i, text_encoder in enumerate(text_encoders):
                         if text_encoder is not None:
                             text_encoder_norm = compute_grad_norm(itertools.chain(text_encoder.parameters())).item()
                             grad_norms[f'text_encoder_{i}'].append(text_encoder_norm)
 
-                optimizer_collection.step()
+                optimizer_collection.step(grad_scaler)
                 optimizer_collection.zero_grad()
 
             #############################################################################################################
             
             if config.debug:
-                # Track the token embedding stds:
-                trainable_embeddings, _ = embedding_handler.get_trainable_embeddings()
-                for idx in range(len(text_encoders)):
-                    if text_encoders[idx] is not None:
-                        embedding_stds = trainable_embeddings[f'txt_encoder_{idx}'].detach().float().std(dim=1)
-                        for std_i, std in enumerate(embedding_stds):
-                            token_stds[f'text_encoder_{idx}'][std_i].append(embedding_stds[std_i].item())
+                # Track the token embedding stds (read-only, so skip all autograd bookkeeping for the indexing ops):
+                with torch.inference_mode():
+                    trainable_embeddings, _ = embedding_handler.get_trainable_embeddings()
+                    for idx in range(len(text_encoders)):
+                        if text_encoders[idx] is not None:
+                            embedding_stds = trainable_embeddings[f'txt_encoder_{idx}'].float().std(dim=1)
+                            for std_i, std in enumerate(embedding_stds):
+                                token_stds[f'text_encoder_{idx}'][std_i].append(embedding_stds[std_i].item())
 
                 if global_step % 50 == 0 and not config.disable_ti and config.debug:
                     img_ratio = config.train_img_size[0] / config.train_img_size[1]
@@ -416,6 +506,7 @@ def train(config: TrainingConfig):
                     pretrained_model_version=config.pretrained_model["version"]
                 )
                 last_save_step = global_step
+                collect_finished_plots()
 
                 if config.debug:
                     embedding_handler.print_token_info()
@@ -473,6 +564,9 @@ def train(config: TrainingConfig):
         plot_lrs(optimizer_collection.learning_rate_tracker, save_path=f'{config.output_dir}/learning_rates.png')
         plot_torch_hist(unet_lora_parameters if config.is_lora else unet.parameters(), global_step, config.output_dir, "lora_weights", min_val=-0.4, max_val=0.4, ymax_f = 0.08)
 
+    # make sure all background plots are on disk (and their errors reported) before the final save:
+    wait_for_plots()
+
     if not os.path.exists(output_save_dir):
         os.makedirs(output_save_dir, exist_ok=True)
         config.save_as_json(os.path.join(output_save_dir, "training_args.json"))
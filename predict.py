@@ -193,4 +193,4 @@ class Predictor(BasePredictor):
         if DEBUG_MODE or debug:
             yield cogPath(out_path)
         else:
-            yield CogOutput(files=[cogPath(out_path)], name=name, thumbnails=[cogPath(validation_grid_img_path)], attributes=config.dict(), isFinal=True, progress=1.0)
\ No newline at end of file
+            yield CogOutput(files=[cogPath(out_path)], name=name, thumbnails=[cogPath(validation_grid_img_path)], attributes=config.model_dump(), isFinal=True, progress=1.0)
\ No newline at end of file
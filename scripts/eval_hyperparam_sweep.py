@@ -14,7 +14,7 @@ def count_jpg_files(directory):
 def load_training_args(directory):
     for root, dirs, files in os.walk(directory):
         if 'training_args.json' in files:
-            with open(os.path.join(root, 'training_args.json'), 'r') as f:
+            with open(os.path.join(root, 'training_args.json'), 'r', encoding='utf-8') as f:
                 return json.load(f)
     return None
 
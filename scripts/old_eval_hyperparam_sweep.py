@@ -42,7 +42,7 @@ for i, exp_subdir in enumerate(sorted(os.listdir(render_dir))):
         
         # Step 3: Load the corresponding .json file
         if os.path.isfile(json_path):
-            with open(json_path, 'r') as file:
+            with open(json_path, 'r', encoding='utf-8') as file:
                 config = json.load(file)
 
                 # Filter out experiments that do not match the filters
@@ -54,7 +54,7 @@ if __name__ == "__main__":
         n_steps = 8
         guidance_scale=1.5
 
-    with open(os.path.join(lora_path, "training_args.json"), "r") as f:
+    with open(os.path.join(lora_path, "training_args.json"), "r", encoding="utf-8") as f:
         training_args = json.load(f)
 
     if training_args["concept_mode"] == "style":
@@ -1,7 +1,9 @@
 from typing import Union, List, Optional
 from datetime import datetime
-from pydantic import BaseModel
-import json, time, os
+from pydantic import BaseModel, ConfigDict, model_validator
+import time, os
+import functools
+from pathlib import Path
 from typing import Literal
 from trainer.utils.utils import pick_best_gpu_id
 
@@ -34,6 +36,21 @@ pretrained_models = {
     "sd15": {"path": os.path.join(model_paths.get_path("SD"), os.path.basename(SD15_URL)), "url": SD15_URL, "version": "sd15"}
 }
 
+@functools.lru_cache(maxsize=1)
+def _cached_best_gpu():
+    # Querying all GPUs is slow, only do it once per process (call _cached_best_gpu.cache_clear() to force a rescan)
+    return pick_best_gpu_id()
+
+@functools.lru_cache(maxsize=None)
+def _pretrained_model_for(sd_model_version):
+    return pretrained_models[sd_model_version]
+
+@functools.lru_cache(maxsize=None)
+def _token_tuples(n_tokens: int):
+    # Cached per n_tokens, returns immutable values so every config gets its own list / dict copy:
+    inserting_list_tokens = tuple(f"<s{i}>" for i in range(n_tokens))
+    return inserting_list_tokens, "".join(inserting_list_tokens)
+
 class TrainingConfig(BaseModel):
     lora_training_urls: str
     concept_mode: Literal["face", "style", "object"]
@@ -66,6 +83,7 @@ class TrainingConfig(BaseModel):
     token_warmup_steps: int = 0    #  warmup the token embeddings with a pure txt loss
     ti_weight_decay: float = 0.0
     ti_optimizer: Literal["adamw", "prodigy"] = "adamw"
+    use_8bit_optim: bool = False   # use bitsandbytes AdamW8bit for the TI / text-encoder LoRA adamw optimizers (saves VRAM)
     freeze_ti_after_completion_f: float = 0.7     # freeze the TI after this fraction of the training is done
     freeze_unet_before_completion_f: float = 0.0  # freeze the UNET before this fraction of the training is done
     
@@ -79,7 +97,8 @@ class TrainingConfig(BaseModel):
     snr_gamma: float = 5.0
     lora_alpha_multiplier: float = 1.0
     lora_rank: int = 16
-    use_dora: bool = False
+    use_dora: bool = False        # DoRA roughly doubles the cost of the LoRA forward pass
+    use_rslora: bool = False      # rank-stabilized LoRA scaling (alpha/sqrt(r)), keeps higher lora_ranks trainable. Note: exported webui files assume alpha/r scaling!
 
     left_right_flip_augmentation: bool = True
     augment_imgs_up_to_n: int = 40
@@ -92,9 +111,13 @@ class TrainingConfig(BaseModel):
     output_dir: str = "eden_lora_training_runs"
     debug: bool = False
     allow_tf32: bool = True
+    compile_unet: bool = False    # torch.compile the unet for the training forward/backward (CUDA only, experimental)
+    cuda_graphs: bool = True      # with compile_unet: replay the compiled unet as CUDA graphs (reduce-overhead mode), uses extra memory per batch shape
+    gradient_checkpointing: bool = False   # trade compute for unet activation memory (allows larger train_batch_size)
     disable_ti: bool = False
     skip_gpt_cleanup: bool = False
     weight_type: Literal["fp16", "bf16", "fp32"] = "bf16"
+    mixed_precision: Literal["no", "bf16", "fp16"] = "no"   # autocast the unet forward + loss (mostly useful with weight_type = "fp32")
     n_tokens: int = 3
     inserting_list_tokens: List[str] = ["<s0>","<s1>","<s2>"]
     token_dict: dict = {"TOK": "<s0><s1><s2>"}
@@ -117,58 +140,74 @@ class TrainingConfig(BaseModel):
     text_encoder_lora_weight_decay: float = 1.0e-5
     text_encoder_lora_rank: int = 16
 
-    def __init__(self, **data):
-        super().__init__(**data)
+    # Derived fields are written straight into __dict__ by _finalize, no per-assignment validation needed:
+    model_config = ConfigDict(validate_assignment=False)
+
+    @model_validator(mode='after')
+    def _finalize(self) -> 'TrainingConfig':
+        # Runs for both TrainingConfig(**data) and model_validate_json().
+        # Collect all derived values first and write them in one go to skip pydantic's __setattr__ on every field:
+        derived = {}
 
         if not self.ckpt_path:
-            self.pretrained_model = pretrained_models[self.sd_model_version]
+            derived["pretrained_model"] = _pretrained_model_for(self.sd_model_version)
         else:
-            self.pretrained_model = {"path": self.ckpt_path, "url": None, "version": None}
+            derived["pretrained_model"] = {"path": self.ckpt_path, "url": None, "version": None}
         
-        if not self.name:
-            self.name = os.path.basename(self.lora_training_urls)[:40]
+        name = self.name or os.path.basename(self.lora_training_urls)[:40]
+        derived["name"] = name
 
         timestamp = datetime.now().strftime("%d%b_%H%M")
-        self.output_dir = self.output_dir + f"/{self.name}_{timestamp}-{self.concept_mode}_res{self.resolution}_{self.max_train_steps}steps"
-        os.makedirs(self.output_dir, exist_ok=True)
+        output_dir = self.output_dir + f"/{name}_{timestamp}-{self.concept_mode}_res{self.resolution}_{self.max_train_steps}steps"
+        derived["output_dir"] = output_dir
 
         if self.seed is None:
-            self.seed = int(time.time())
+            derived["seed"] = int(time.time())
 
         if self.unet_lr_warmup_steps is None:
-            self.unet_lr_warmup_steps = self.max_train_steps
+            derived["unet_lr_warmup_steps"] = self.max_train_steps
 
         if self.checkpointing_steps < 1:
-            self.checkpointing_steps = self.max_train_steps
+            derived["checkpointing_steps"] = self.max_train_steps
 
         if self.concept_mode == "face":
             print(f"Face mode is active ----> disabling left-right flips and setting mask_target_prompts to 'face'.")
-            self.left_right_flip_augmentation = False  # always disable lr flips for face mode!
-            self.mask_target_prompts = "face"
-            #self.use_face_detection_instead = True
+            derived["left_right_flip_augmentation"] = False  # always disable lr flips for face mode!
+            derived["mask_target_prompts"] = "face"
+            #derived["use_face_detection_instead"] = True
         
         if self.use_dora:
             print(f"Disabling L1 penalty and LoRA weight decay for DORA training.")
-            self.l1_penalty = 0.0
-            self.lora_weight_decay = 0.0
-            self.text_encoder_lora_weight_decay = 0.0
+            derived["l1_penalty"] = 0.0
+            derived["lora_weight_decay"] = 0.0
+            derived["text_encoder_lora_weight_decay"] = 0.0
 
         # build the inserting_list_tokens and token dict using n_tokens:
-        inserting_list_tokens = [f"<s{i}>" for i in range(self.n_tokens)]
-        self.inserting_list_tokens = inserting_list_tokens
-        self.token_dict = {"TOK": "".join(inserting_list_tokens)}
+        inserting_list_tokens, token_string = _token_tuples(self.n_tokens)
+        derived["inserting_list_tokens"] = list(inserting_list_tokens)
+        derived["token_dict"] = {"TOK": token_string}
 
-        gpu_id = pick_best_gpu_id()
-        self.device = f'cuda:{gpu_id}'
-        self.start_time = time.time()
+        gpu_id = _cached_best_gpu()
+        derived["device"] = f'cuda:{gpu_id}'
+        derived["start_time"] = time.time()
+
+        self.__dict__.update(derived)
+        return self
+
+    def ensure_output_dir(self) -> str:
+        # Create output_dir when training starts instead of on every construction.
+        # Only the local rank 0 process creates it to avoid multiple workers racing on the same path.
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            os.makedirs(self.output_dir, exist_ok=True)
+        return self.output_dir
 
     @classmethod
     def from_json(cls, file_path: str):
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-
-        return cls(**data)
+        # pydantic-core parses + validates the raw bytes in one pass:
+        return cls.model_validate_json(Path(file_path).read_bytes())
     
     def save_as_json(self, file_path: str) -> None:
-        with open(file_path, 'w') as f:
-            json.dump(self.dict(), f, indent=4)
\ No newline at end of file
+        # pydantic-core serializes straight to (UTF-8) JSON bytes, all readers of training_args.json open it as utf-8:
+        data = self.model_dump_json(indent=4).encode()
+        with open(file_path, 'wb') as f:
+            f.write(data)
\ No newline at end of file
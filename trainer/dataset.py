@@ -127,6 +127,7 @@ class PreprocessedDataset(Dataset):
     def __len__(self) -> int:
         return len(self.data)
 
+    # Note: no_grad and not inference_mode, the cached latents / masks are used by the training loss (inference tensors can't be saved for backward)
     @torch.no_grad()
     def _process(
         self, idx: int, bucketing_resolution: tuple = None
@@ -238,7 +238,7 @@ class TokenEmbeddingsHandler:
             prompt=captions,
             device=pipe.unet.device,
             num_images_per_prompt=1,
-            do_classifier_free_guidance=True,
+            do_classifier_free_guidance=False,  # the negative embeddings are never used during training, don't compute them
             negative_prompt=None,
             clip_skip=None,
         )
@@ -393,7 +393,7 @@ class TokenEmbeddingsHandler:
                 embedding_tensor.grad.data[:-config.n_tokens, : ] *= 0.
 
             optimizer_ti.step()
-            optimizer_ti.zero_grad()
+            optimizer_ti.zero_grad(set_to_none=True)
 
         if config.debug:
             plot_loss(losses, save_path=f'{config.output_dir}/token_warmup_loss.png')
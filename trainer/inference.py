@@ -50,7 +50,7 @@ def prepare_prompt_for_lora(prompt, lora_path, interpolation=False, verbose=True
 
     # Helper function to read JSON
     def read_json_from_path(path):
-        with open(path, "r") as f:
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
 
     # Check existence of "special_params.json"
@@ -128,12 +128,13 @@ def prepare_prompt_for_lora(prompt, lora_path, interpolation=False, verbose=True
 
 
 
-def get_conditioning_signals(config, pipe, captions):
+def get_conditioning_signals(config, pipe, captions, add_time_ids_cache = None):
+    # add_time_ids_cache: optional dict owned by the training run, reuses the (constant) add_time_ids across steps
     conditioning_signals = pipe.encode_prompt(
         prompt=captions,
         device=pipe.unet.device,
         num_images_per_prompt=1,
-        do_classifier_free_guidance=True,
+        do_classifier_free_guidance=False,  # the negative embeddings are never used during training, don't compute them
         negative_prompt=None,
         clip_skip=None,
     )
@@ -162,21 +163,64 @@ def get_conditioning_signals(config, pipe, captions):
         else:
             text_encoder_projection_dim = pipe.text_encoder_2.config.projection_dim
 
-        add_time_ids = pipe._get_add_time_ids(
-            original_size,
-            crops_coords_top_left,
-            target_size,
-            dtype=prompt_embeds.dtype,
-            text_encoder_projection_dim=text_encoder_projection_dim,
-        )
+        # add_time_ids are constant for given size / crop inputs, build them once per run and broadcast (view, no copy) to the batch size:
+        cache_key = (original_size, crops_coords_top_left, target_size, text_encoder_projection_dim, prompt_embeds.dtype, str(config.device))
+        if add_time_ids_cache is None or cache_key not in add_time_ids_cache:
+            add_time_ids = pipe._get_add_time_ids(
+                original_size,
+                crops_coords_top_left,
+                target_size,
+                dtype=prompt_embeds.dtype,
+                text_encoder_projection_dim=text_encoder_projection_dim,
+            ).to(config.device, dtype=prompt_embeds.dtype)
+            if add_time_ids_cache is not None:
+                add_time_ids_cache[cache_key] = add_time_ids
+        else:
+            add_time_ids = add_time_ids_cache[cache_key]
 
-        add_time_ids = add_time_ids.to(config.device, dtype=prompt_embeds.dtype).repeat(
-            prompt_embeds.shape[0], 1
+        add_time_ids = add_time_ids.expand(
+            prompt_embeds.shape[0], -1
         )
 
     return prompt_embeds, pooled_prompt_embeds, add_time_ids
 
 
+def _stack_into_buffer(buffers, name, tensors):
+    # Stack into a persistent output tensor (only reallocated when the batch shape changes) instead of a fresh allocation per step.
+    # Safe because the previous step's backward is always done before the buffer gets overwritten.
+    shape = (len(tensors),) + tuple(tensors[0].shape)
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != tensors[0].dtype or buffer.device != tensors[0].device:
+        buffer = torch.empty(shape, dtype=tensors[0].dtype, device=tensors[0].device)
+        buffers[name] = buffer
+    return torch.stack(tensors, out=buffer)
+
+@torch.no_grad()
+def get_cached_conditioning_signals(config, pipe, captions, cache: dict, buffers: dict):
+    """
+    Same as get_conditioning_signals(), but stores the per-caption text encoder outputs in `cache`
+    so every unique caption is only encoded once, the batch is stacked into the output tensors in `buffers`.
+    Both dicts are owned by the training run (nothing is kept alive across runs).
+    Only valid while neither the token embeddings nor the text encoders are being trained!
+    """
+    missing_captions = [caption for caption in dict.fromkeys(captions) if caption not in cache]
+    if missing_captions:
+        prompt_embeds, pooled_prompt_embeds, add_time_ids = get_conditioning_signals(config, pipe, missing_captions)
+        for i, caption in enumerate(missing_captions):
+            cache[caption] = (
+                prompt_embeds[i],
+                None if pooled_prompt_embeds is None else pooled_prompt_embeds[i],
+                None if add_time_ids is None else add_time_ids[i],
+            )
+
+    prompt_embeds, pooled_prompt_embeds, add_time_ids = zip(*[cache[caption] for caption in captions])
+    prompt_embeds = _stack_into_buffer(buffers, "prompt_embeds", prompt_embeds)
+    pooled_prompt_embeds = None if pooled_prompt_embeds[0] is None else _stack_into_buffer(buffers, "pooled_prompt_embeds", pooled_prompt_embeds)
+    add_time_ids = None if add_time_ids[0] is None else _stack_into_buffer(buffers, "add_time_ids", add_time_ids)
+
+    return prompt_embeds, pooled_prompt_embeds, add_time_ids
+
+
 def blend_conditions(
     embeds1,
     embeds2,
@@ -310,7 +354,7 @@ def render_images(
     
     random.seed(seed)
 
-    with open(os.path.join(lora_path, "training_args.json"), "r") as f:
+    with open(os.path.join(lora_path, "training_args.json"), "r", encoding="utf-8") as f:
         training_args = json.load(f)
         concept_mode = training_args["concept_mode"]
 
@@ -105,6 +105,16 @@ def compute_snr(noise_scheduler, timesteps):
     snr = (alpha / sigma) ** 2
     return snr
 
+# SNR only depends on the (fixed) alphas_cumprod of the scheduler, so compute it once for all timesteps
+# (cached on the scheduler itself, so it lives and dies with the scheduler of the current run):
+def get_snr_table(noise_scheduler, device):
+    snr_table = getattr(noise_scheduler, "_snr_table", None)
+    if snr_table is None or snr_table.device != torch.device(device):
+        all_timesteps = torch.arange(len(noise_scheduler.alphas_cumprod), device=device)
+        snr_table = compute_snr(noise_scheduler, all_timesteps)
+        noise_scheduler._snr_table = snr_table
+    return snr_table
+
 def compute_grad_norm(parameters, norm_type = 2.0, foreach = None, error_if_nonfinite = False):
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
@@ -124,6 +134,28 @@ def compute_grad_norm(parameters, norm_type = 2.0, foreach = None, error_if_nonf
 
     return total_norm
 
+def masked_mse(model_pred, target, mask):
+    """
+    Per-sample masked mse, modulated by the inverse of each mask's (relative) mean value
+    """
+    loss = (model_pred - target).pow(2) * mask
+
+    # Keep the mask statistics in fp32 (also under autocast):
+    mask = mask.float()
+    mean_mask_values = mask.flatten(1).mean(1)
+    mean_mask_values = mean_mask_values / mean_mask_values.mean()
+    return loss.flatten(1).mean(1) / mean_mask_values
+
+_compiled_masked_mse = None
+def get_masked_mse(use_compile):
+    # With compile_unet, let inductor fuse the sub / square / mask / reduce into a single kernel:
+    global _compiled_masked_mse
+    if not use_compile:
+        return masked_mse
+    if _compiled_masked_mse is None:
+        _compiled_masked_mse = torch.compile(masked_mse)
+    return _compiled_masked_mse
+
 def compute_diffusion_loss(config, model_pred, noise, noisy_latent, mask, noise_scheduler, timesteps):
     # Get the unet prediction target depending on the prediction type:
     if noise_scheduler.config.prediction_type == "epsilon":
@@ -134,23 +166,14 @@ def compute_diffusion_loss(config, model_pred, noise, noisy_latent, mask, noise_
     else:
         raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
         
-    loss = (model_pred - target).pow(2) * mask
-
-    if config.snr_gamma is None or config.snr_gamma == 0.0:
-        # modulate loss by the inverse of the mask's mean value
-        mean_mask_values = mask.mean(dim=list(range(1, len(loss.shape))))
-        mean_mask_values = mean_mask_values / mean_mask_values.mean()
-        loss = loss.mean(dim=list(range(1, len(loss.shape)))) / mean_mask_values
-        loss = loss.mean()
+    loss = get_masked_mse(config.compile_unet and model_pred.is_cuda)(model_pred, target, mask)
 
-    else:
+    if config.snr_gamma is not None and config.snr_gamma != 0.0:
         # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
         # Since we predict the noise instead of x_0, the original formulation is slightly changed.
         # This is discussed in Section 4.2 of the same paper.
-        snr = compute_snr(noise_scheduler, timesteps)
-        base_weight = (
-            torch.stack([snr, config.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
-        )
+        snr = get_snr_table(noise_scheduler, timesteps.device).index_select(0, timesteps)
+        base_weight = snr.clamp(max=config.snr_gamma) / snr
         if noise_scheduler.config.prediction_type == "v_prediction":
             # Velocity objective needs to be floored to an SNR weight of one.
             mse_loss_weights = base_weight + 1
@@ -159,15 +182,9 @@ def compute_diffusion_loss(config, model_pred, noise, noisy_latent, mask, noise_
             mse_loss_weights = base_weight
 
         mse_loss_weights = mse_loss_weights / mse_loss_weights.mean()
-        loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
-
-        # modulate loss by the inverse of the mask's mean value
-        mean_mask_values = mask.mean(dim=list(range(1, len(loss.shape))))
-        mean_mask_values = mean_mask_values / mean_mask_values.mean()
-        loss = loss.mean(dim=list(range(1, len(loss.shape)))) / mean_mask_values
-        loss = loss.mean()
+        loss = loss * mse_loss_weights
 
-    return loss
+    return loss.mean()
 
 class ConditioningRegularizer:
     """
@@ -218,7 +235,7 @@ class ConditioningRegularizer:
             
             mean_reg_loss = torch.stack(tot_reg_losses).mean()
             loss += self.config.tok_cov_reg_w * mean_reg_loss
-            losses['covariance_tok_reg_loss'].append(mean_reg_loss.item())
+            losses['covariance_tok_reg_loss'].append(mean_reg_loss.detach())
 
         if std_loss_w > 0.0:
             tot_std_losses = []
@@ -228,7 +245,7 @@ class ConditioningRegularizer:
             
             mean_std_loss = torch.stack(tot_std_losses).mean()
             loss += std_loss_w * mean_std_loss
-            losses['token_std_loss'].append(mean_std_loss.item())
+            losses['token_std_loss'].append(mean_std_loss.detach())
 
         return loss, losses, prompt_embeds_norms
 
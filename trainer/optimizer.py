@@ -1,8 +1,56 @@
 from peft import LoraConfig, get_peft_model
 import torch
-import prodigyopt
 from typing import Iterable
 
+# LoRA target modules as a single regex (peft does one re.fullmatch per module name instead of looping over a list of suffixes):
+UNET_LORA_TARGET_MODULES = r".*\.(to_k|to_q|to_v|to_out\.0|conv2)$"
+TEXT_ENCODER_LORA_TARGET_MODULES = r".*\.(k_proj|q_proj|v_proj|out_proj)$"
+
+def get_adamw_kwargs():
+    # Use the fused CUDA kernel (one launch for all params) when possible, otherwise the multi-tensor foreach path:
+    if torch.cuda.is_available():
+        return {"fused": True}
+    return {"foreach": True}
+
+def make_adamw(params, use_8bit_optim: bool = False, **kwargs):
+    # 8-bit AdamW block-quantizes the moment estimates (~4x less optimizer state), falls back to torch AdamW without bitsandbytes:
+    if use_8bit_optim:
+        try:
+            import bitsandbytes as bnb
+            return bnb.optim.AdamW8bit(params, **kwargs)
+        except ImportError:
+            print("bitsandbytes is not installed, falling back to torch.optim.AdamW")
+    return torch.optim.AdamW(params, **kwargs, **get_adamw_kwargs())
+
+def _make_unet_adamw(unet_trainable_params, lora_weight_decay, use_dora, **kwargs):
+    return torch.optim.AdamW(unet_trainable_params, lr = 1e-4, weight_decay=lora_weight_decay if not use_dora else 0.0, **get_adamw_kwargs())
+
+def _make_unet_adamw8bit(unet_trainable_params, lora_weight_decay, **kwargs):
+    import bitsandbytes as bnb
+    return bnb.optim.AdamW8bit(unet_trainable_params, lr = 1e-4, weight_decay=lora_weight_decay)
+
+def _make_unet_prodigy(unet_trainable_params, lora_weight_decay, use_dora, prodigy_d_coef, prodigy_growth_factor):
+    import prodigyopt
+    # Note: the specific settings of Prodigy seem to matter A LOT
+    return prodigyopt.Prodigy(
+        unet_trainable_params,
+        d_coef = prodigy_d_coef,
+        lr=1.0,
+        decouple=True,
+        use_bias_correction=True,
+        safeguard_warmup=True,
+        weight_decay=lora_weight_decay if not use_dora else 0.0,
+        betas=(0.9, 0.99),
+        growth_rate=prodigy_growth_factor  # lower values make the lr go up slower (1.01 is for 1k step runs, 1.02 is for 500 step runs)
+    )
+
+# Optional optimizer packages (prodigyopt, bitsandbytes) are only imported when their builder is actually used:
+_UNET_OPT_BUILDERS = {
+    "adamw": _make_unet_adamw,
+    "AdamW8bit": _make_unet_adamw8bit,
+    "prodigy": _make_unet_prodigy,
+}
+
 def get_unet_optimizer(
     prodigy_d_coef: float,
     prodigy_growth_factor: float,
@@ -14,26 +62,16 @@ def get_unet_optimizer(
     ## unet_trainable_params can be unet.parameters() or a list of lora params
     
     # These learning rates will get overwritten in main.py:
-    if optimizer_name == "adamw":
-        optimizer_unet = torch.optim.AdamW(unet_trainable_params, lr = 1e-4, weight_decay=lora_weight_decay if not use_dora else 0.0)
-    elif optimizer_name == "AdamW8bit":
-        import bitsandbytes as bnb
-        optimizer_unet = bnb.optim.AdamW8bit(unet_trainable_params, lr = 1e-4, weight_decay=lora_weight_decay)
-    elif optimizer_name == "prodigy":
-        # Note: the specific settings of Prodigy seem to matter A LOT
-        optimizer_unet = prodigyopt.Prodigy(
-            unet_trainable_params,
-            d_coef = prodigy_d_coef,
-            lr=1.0,
-            decouple=True,
-            use_bias_correction=True,
-            safeguard_warmup=True,
-            weight_decay=lora_weight_decay if not use_dora else 0.0,
-            betas=(0.9, 0.99),
-            growth_rate=prodigy_growth_factor  # lower values make the lr go up slower (1.01 is for 1k step runs, 1.02 is for 500 step runs)
-        )
-    else:
+    if optimizer_name not in _UNET_OPT_BUILDERS:
         raise NotImplementedError(f"Invalid optimizer_name for unet: {optimizer_name}")
+
+    optimizer_unet = _UNET_OPT_BUILDERS[optimizer_name](
+        unet_trainable_params,
+        lora_weight_decay=lora_weight_decay,
+        use_dora=use_dora,
+        prodigy_d_coef=prodigy_d_coef,
+        prodigy_growth_factor=prodigy_growth_factor,
+    )
     
     print(f"Created {optimizer_name} optimizer for unet!")
     return optimizer_unet
@@ -78,10 +116,11 @@ def get_unet_lora_parameters(
     use_dora: bool,
     unet,
     pipe,
+    use_rslora: bool = False,
 ):
     
     #target_modules = get_unet_lora_target_modules(unet, use_blora=True)
-    target_modules = ["to_k", "to_q", "to_v", "to_out.0", "conv2"]
+    target_modules = UNET_LORA_TARGET_MODULES
 
     unet_lora_config = LoraConfig(
         r=lora_rank,
@@ -89,13 +128,17 @@ def get_unet_lora_parameters(
         init_lora_weights="gaussian",
         target_modules=target_modules,
         use_dora=use_dora,
+        use_rslora=use_rslora,
     )
 
     #unet.add_adapter(unet_lora_config)
+    unet.requires_grad_(False)
     unet = get_peft_model(unet, unet_lora_config)
     pipe.unet = unet
     
-    unet_lora_parameters = list(filter(lambda p: p.requires_grad, unet.parameters()))
+    # Note: the adapters are intentionally kept as separate peft tensors (stacking them into one shared storage breaks
+    # get_peft_model_state_dict / safetensors saving), the per-tensor launch overhead is handled by the fused AdamW instead.
+    unet_lora_parameters = [p for p in unet.parameters() if p.requires_grad]
     unet_trainable_params = [
         {
             "params": unet_lora_parameters,
@@ -108,20 +151,26 @@ def get_textual_inversion_optimizer(
     text_encoders: list,
     textual_inversion_lr: float,
     textual_inversion_weight_decay,
-    optimizer_name: str
+    optimizer_name: str,
+    freeze_text_encoders: bool = True,
+    use_8bit_optim: bool = False
 ):
     text_encoder_parameters = []
     for text_encoder in text_encoders:
         if text_encoder is not  None:
             text_encoder.train()
-            for name, param in text_encoder.named_parameters():
-                if "token_embedding" in name:
-                    #param.data = param.to(dtype=torch.float32)
-                    param.requires_grad = True
-                    text_encoder_parameters.append(param)
-                    print(f"Added {name} with shape {param.shape} to the trainable parameters")
-                else:
-                    pass
+            # Make sure nothing but the token_embedding stays trainable.
+            # (skipped when text-encoder LoRA is active: peft already froze the base weights and the adapters must stay trainable)
+            if freeze_text_encoders:
+                text_encoder.requires_grad_(False)
+            # Only the token_embedding is trained, grab it directly instead of scanning all named_parameters():
+            token_embedding = text_encoder.get_input_embeddings()
+            token_embedding.requires_grad_(True)
+            for param in token_embedding.parameters():
+                #param.data = param.to(dtype=torch.float32)
+                text_encoder_parameters.append(param)
+
+    print(f"Added {len(text_encoder_parameters)} token_embedding tensors to the trainable parameters")
 
     params_to_optimize_ti = [
         {
@@ -132,6 +181,7 @@ def get_textual_inversion_optimizer(
     ]
 
     if optimizer_name == "prodigy":
+        import prodigyopt
         optimizer_ti = prodigyopt.Prodigy(
                             params_to_optimize_ti,
                             d_coef = 1.0,
@@ -144,8 +194,9 @@ def get_textual_inversion_optimizer(
                             #growth_rate=1.5,  # this slows down the lr_rampup
                         )
     elif  optimizer_name == "adamw":
-        optimizer_ti = torch.optim.AdamW(
+        optimizer_ti = make_adamw(
             params_to_optimize_ti,
+            use_8bit_optim=use_8bit_optim,
             weight_decay=textual_inversion_weight_decay,
         )
     else:
@@ -159,11 +210,12 @@ def get_text_encoder_lora_parameters(text_encoder, lora_rank, lora_alpha_multipl
         r=lora_rank,
         lora_alpha=lora_rank * lora_alpha_multiplier,
         init_lora_weights="gaussian",
-        target_modules=["k_proj", "q_proj", "v_proj", "out_proj"],
+        target_modules=TEXT_ENCODER_LORA_TARGET_MODULES,
         use_dora=use_dora,
     )
+    text_encoder.requires_grad_(False)
     text_encoder_peft_model = get_peft_model(text_encoder, text_encoder_lora_config)
-    text_encoder_lora_params = list(filter(lambda p: p.requires_grad, text_encoder_peft_model.parameters()))
+    text_encoder_lora_params = [p for p in text_encoder_peft_model.parameters() if p.requires_grad]
     return text_encoder_peft_model, text_encoder_lora_params
 
 def get_optimizer_and_peft_models_text_encoder_lora(
@@ -173,7 +225,8 @@ def get_optimizer_and_peft_models_text_encoder_lora(
     use_dora: bool, 
     optimizer_name: str,
     lora_lr: float,
-    weight_decay: float
+    weight_decay: float,
+    use_8bit_optim: bool = False
 ):
     text_encoder_lora_parameters = []
     text_encoder_peft_models = []
@@ -191,10 +244,11 @@ def get_optimizer_and_peft_models_text_encoder_lora(
             text_encoder_peft_models.append(None)
 
     if optimizer_name == "adamw":
-        optimizer_text_encoder_lora = torch.optim.AdamW(
+        optimizer_text_encoder_lora = make_adamw(
                 text_encoder_lora_parameters, 
+                use_8bit_optim=use_8bit_optim,
                 lr =  lora_lr,
-                weight_decay=weight_decay if not use_dora else 0.0
+                weight_decay=weight_decay if not use_dora else 0.0,
             )
     else:
         raise NotImplementedError(f"Text encoder LoRA finetuning is not yet implemented for optimizer: {optimizer_name}")
@@ -203,36 +257,47 @@ def get_optimizer_and_peft_models_text_encoder_lora(
 
 
 
+def _ensure_group_numel(optimizer):
+    # The set of trainable params in a group doesn't change during training, count them once and store the count in the group:
+    for group in optimizer.param_groups:
+        if '_num_params' not in group:
+            group['_num_params'] = sum(p.numel() for p in group['params'] if p.requires_grad)
+
 def get_current_lr(optimizer):
     """
     Helper class to get the current lr for various types of optimizers
     """
-    try:
-        # Calculate the weighted average effective learning rate
-        total_lr = 0
-        total_params = 0
-        for group in optimizer.param_groups:
-            d = group['d']
-            lr = group['lr']
-            bias_correction = 1  # Default value
-            if group['use_bias_correction']:
-                beta1, beta2 = group['betas']
-                k = group['k']
-                bias_correction = ((1 - beta2**(k+1))**0.5) / (1 - beta1**(k+1))
-
-            effective_lr = d * lr * bias_correction
-
-            # Count the number of parameters in this group
-            num_params = sum(p.numel() for p in group['params'] if p.requires_grad)
-            total_lr += effective_lr * num_params
-            total_params += num_params
-
-        if total_params == 0:
-            return 0.0
-        else: return total_lr / total_params
-    except:
+    if 'd' not in optimizer.param_groups[0]:
+        # Not a Prodigy-style optimizer (no adapted d), the lr is the effective lr:
         return optimizer.param_groups[0]['lr']
 
+    # Calculate the weighted average effective learning rate
+    _ensure_group_numel(optimizer)
+    total_lr = 0
+    total_params = 0
+    for group in optimizer.param_groups:
+        d = group.get('d', 1.0)
+        lr = group['lr']
+        bias_correction = 1  # Default value
+        if group.get('use_bias_correction', False):
+            beta1, beta2 = group['betas']
+            k = group.get('k', 0)
+            bias_correction = ((1 - beta2**(k+1))**0.5) / (1 - beta1**(k+1))
+
+        effective_lr = d * lr * bias_correction
+
+        # Number of parameters in this group (cached)
+        num_params = group['_num_params']
+        total_lr += effective_lr * num_params
+        total_params += num_params
+
+    if total_params == 0:
+        return 0.0
+    else: return total_lr / total_params
+
+
+def _has_grads(optimizer):
+    return any(p.grad is not None for group in optimizer.param_groups for p in group['params'])
 
 class OptimizerCollection:
     def __init__(
@@ -254,23 +319,51 @@ class OptimizerCollection:
 
         self.learning_rate_tracker = {'textual_inversion':[], 'text_encoders':[], 'unet':[]}
 
+        # Filter out the disabled optimizers once, so the per-step calls don't have to:
+        self._active = tuple((key, optimizer) for key, optimizer in self.optimizers.items() if optimizer is not None)
+
         print("--> Initialized optimizers for:")
-        for key in self.optimizers.keys():
-            if self.optimizers[key] is not None:
-                print(key)
+        for key, _ in self._active:
+            print(key)
+
+    def release(self, key):
+        """
+        Permanently remove an optimizer from the collection and free its state tensors
+        (the optimizers dict is shared with the training loop, so optimizers[key] becomes None there as well)
+        """
+        optimizer = self.optimizers[key]
+        if optimizer is None:
+            return
+        optimizer.state.clear()
+        self.optimizers[key] = None
+        self._active = tuple((k, opt) for k, opt in self._active if k != key)
 
     def get_lr(self, key):
         return get_current_lr(self.optimizers[key])
 
     def zero_grad(self):
-        for key in self.optimizers.keys():
-            if self.optimizers[key] is not None:
-                self.optimizers[key].zero_grad()
+        # set_to_none skips the memset kernel for every gradient tensor:
+        for _, optimizer in self._active:
+            optimizer.zero_grad(set_to_none=True)
     
-    def step(self):
-        for key in self.optimizers.keys():
-            if self.optimizers[key] is not None:
-                self.optimizers[key].step()
-                if self.debug:
-                    self.learning_rate_tracker[key].append(get_current_lr(self.optimizers[key]))
-                
\ No newline at end of file
+    def unscale_(self, grad_scaler):
+        # divide the grads by the loss scale in place (e.g. to measure grad norms), step() won't unscale them a second time
+        for _, optimizer in self._active:
+            if _has_grads(optimizer):
+                grad_scaler.unscale_(optimizer)
+
+    def step(self, grad_scaler = None):
+        # grad_scaler: optional torch.cuda.amp.GradScaler (fp16 mixed precision), a disabled scaler just calls optimizer.step()
+        scaler_stepped = False
+        for key, optimizer in self._active:
+            # GradScaler.step() asserts when an optimizer recorded no inf checks (= none of its params got a grad this step):
+            if grad_scaler is not None and _has_grads(optimizer):
+                grad_scaler.step(optimizer)
+                scaler_stepped = True
+            else:
+                optimizer.step()
+            if self.debug:
+                self.learning_rate_tracker[key].append(get_current_lr(optimizer))
+
+        if scaler_stepped:
+            grad_scaler.update()
@@ -1,4 +1,5 @@
 import os
+import types
 from typing import Dict, List, Optional, Tuple
 
 import random
@@ -10,21 +11,30 @@ import torch
 import torch.utils.checkpoint
 from diffusers import AutoencoderKL, DDPMScheduler, EulerDiscreteScheduler, UNet2DConditionModel, StableDiffusionPipeline, StableDiffusionXLPipeline
 from PIL import Image
-from safetensors import safe_open
-from safetensors.torch import save_file
 from torch.utils.data import Dataset
 from transformers import AutoTokenizer, PretrainedConfig
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-dtype_map = {
+_dtypes = {
     "fp16": torch.float16,
     "bf16": torch.bfloat16,
     "fp32": torch.float32
 }
+# fp8 storage dtypes (torch >= 2.1), not selectable as weight_type (yet) but available for quantized code paths:
+if hasattr(torch, "float8_e4m3fn"):
+    _dtypes["fp8_e4m3"] = torch.float8_e4m3fn
+    _dtypes["fp8_e5m2"] = torch.float8_e5m2
+
+# read-only view, the dtype mapping is fixed for the lifetime of the process:
+dtype_map = types.MappingProxyType(_dtypes)
 
 import re
 def replace_in_string(s, replacements):
+    # targets are replaced one after another (in dict order) until nothing changes anymore, replacements can chain
+    # (re.sub caches the compiled patterns itself)
     while True:
         replaced = False
         for target, replacement in replacements.items():
@@ -36,40 +46,96 @@ def replace_in_string(s, replacements):
             break
     return s
 
+# fix_prompt patterns, compiled once:
+_WS_RE = re.compile(r"\s+")
+_DCOMMA_RE = re.compile(r",,")
+_COMMA_RE = re.compile(r"\s?,\s?")
+_PERIOD_RE = re.compile(r"\s?\.\s?")
+
 def fix_prompt(prompt: str):
     if not prompt:
         return prompt
     # Remove extra commas and spaces, and fix space before punctuation
-    prompt = re.sub(r"\s+", " ", prompt)  # Replace multiple spaces with a single space
-    prompt = re.sub(r",,", ",", prompt)  # Replace double commas with a single comma
-    prompt = re.sub(r"\s?,\s?", ", ", prompt)  # Fix spaces around commas
-    prompt = re.sub(r"\s?\.\s?", ". ", prompt)  # Fix spaces around periods
+    # (the comma and period rules are kept as separate passes, a fused pattern gives different results for e.g. "a , . b")
+    prompt = _WS_RE.sub(" ", prompt)  # Replace multiple spaces with a single space
+    prompt = _DCOMMA_RE.sub(",", prompt)  # Replace double commas with a single comma
+    prompt = _COMMA_RE.sub(", ", prompt)  # Fix spaces around commas
+    prompt = _PERIOD_RE.sub(". ", prompt)  # Fix spaces around periods
     return prompt.strip()  # Remove leading and trailing whitespace
 
 def seed_everything(seed: int):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+
+def get_cudagraph_mark_step_begin():
+    """
+    Returns the function that marks the start of a new (cudagraph-replayed) training step:
+    torch.compiler.cudagraph_mark_step_begin on newer torch versions, torch._inductor.cudagraph_mark_step_begin on torch 2.1
+    """
+    mark_step_begin = getattr(torch.compiler, "cudagraph_mark_step_begin", None)
+    if mark_step_begin is None:
+        import torch._inductor
+        mark_step_begin = torch._inductor.cudagraph_mark_step_begin
+    return mark_step_begin
+
+def _scan_files(path):
+    # recursive os.scandir (uses the cached dir entry types, no extra stat calls), doesn't follow symlinked dirs just like os.walk
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan_files(entry.path)
+        else:
+            yield entry
 
 def zipdir(path, ziph, extension = '.py'):
-    # Zip the directory
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.endswith(extension):
-                ziph.write(os.path.join(root, file),
-                           os.path.relpath(os.path.join(root, file), 
-                                           os.path.join(path, '..')))
+    # Zip the directory, archive names are relative to the parent of path
+    path = os.path.abspath(path)
+    prefix_len = len(os.path.join(os.path.dirname(path), ''))
+    for entry in _scan_files(path):
+        if entry.name.endswith(extension):
+            ziph.write(entry.path, entry.path[prefix_len:])
+
+def _get_free_gpu_memory_nvml():
+    """
+    Free memory (bytes) per GPU straight from the driver, without creating a CUDA context on every device (which reserves VRAM).
+    nvml enumerates GPUs in PCI bus order and ignores CUDA_VISIBLE_DEVICES, so this returns None (= use torch instead) when
+    pynvml isn't installed, CUDA_VISIBLE_DEVICES is set, or there are multiple GPUs and CUDA isn't using CUDA_DEVICE_ORDER=PCI_BUS_ID.
+    """
+    if os.environ.get("CUDA_VISIBLE_DEVICES") is not None:
+        return None
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+    except Exception:
+        return None
+    try:
+        n_gpus = pynvml.nvmlDeviceGetCount()
+        if n_gpus > 1 and os.environ.get("CUDA_DEVICE_ORDER") != "PCI_BUS_ID":
+            # torch's default (FASTEST_FIRST) device order can differ from nvml's
+            return None
+        handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(n_gpus)]
+        return [pynvml.nvmlDeviceGetMemoryInfo(handle).free for handle in handles]
+    finally:
+        pynvml.nvmlShutdown()
 
 def pick_best_gpu_id():
     try:
         # pick the GPU with the most free memory:
-        gpu_ids = [i for i in range(torch.cuda.device_count())]
+        gpu_mem = _get_free_gpu_memory_nvml()
+        if gpu_mem is None:
+            gpu_mem = []
+            for gpu_id in range(torch.cuda.device_count()):
+                # query inside a device context, on older torch versions mem_get_info(device=...) reported the current device
+                with torch.cuda.device(gpu_id):
+                    free_memory, tot_mem = torch.cuda.mem_get_info()
+                gpu_mem.append(free_memory)
+            torch.cuda.empty_cache()
+
+        gpu_ids = [i for i in range(len(gpu_mem))]
         print(f"# of visible GPUs: {len(gpu_ids)}")
-        gpu_mem = []
-        for gpu_id in gpu_ids:
-            free_memory, tot_mem = torch.cuda.mem_get_info(device=gpu_id)
-            gpu_mem.append(free_memory)
+        for gpu_id, free_memory in zip(gpu_ids, gpu_mem):
             print("GPU %d: %d MB free" %(gpu_id, free_memory / 1024 / 1024))
         
         if len(gpu_ids) == 0:
@@ -118,140 +184,223 @@ def print_system_info():
     return
 
 
-def plot_torch_hist(parameters, step, checkpoint_dir, name, bins=100, min_val=-1, max_val=1, ymax_f = 0.75, color = 'blue'):
-    try:
-        os.makedirs(checkpoint_dir, exist_ok=True)
+from concurrent.futures import ThreadPoolExecutor
+# Rendering + png encoding runs in the background, overlapping with the next training steps:
+_PLOT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plotting")
+_pending_plots = []
 
-        # Flatten and concatenate all parameters into a single tensor
-        all_params = torch.cat([p.data.view(-1) for p in parameters])
+def _report_plot_error(future):
+    if future.exception() is not None:
+        print(f'Error in background plot: {future.exception()!r}')
+
+def collect_finished_plots():
+    """
+    Drop the finished background plots (and print their errors), called at every checkpoint
+    """
+    still_running = []
+    for future in _pending_plots:
+        if future.done():
+            _report_plot_error(future)
+        else:
+            still_running.append(future)
+    _pending_plots[:] = still_running
+
+def wait_for_plots():
+    """
+    Block until all background plots have been written to disk
+    """
+    while _pending_plots:
+        future = _pending_plots.pop(0)
+        future.exception()  # blocks until done
+        _report_plot_error(future)
+
+def _new_figure(figsize=None):
+    # Figure + Agg canvas directly (no pyplot figure registry / global state), these figures don't need plt.close()
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+_HIST_CHUNK_SIZE = 2**20
+
+def plot_torch_hist(parameters, step, checkpoint_dir, name, bins=100, min_val=-1, max_val=1, ymax_f = 0.75, color = 'blue', max_hist_samples = 1_000_000):
+    try:
+        if torch.is_tensor(parameters): # a single tensor, not an iterable of parameters
+            parameters = [parameters]
+        # reshape: only copies the (few, small) non-contiguous tensors, e.g. channels_last conv weights
+        parameters = [p.data.reshape(-1) for p in parameters]
 
         # count number of parameters:
-        n_params = len(all_params)
+        n_params = sum(p.numel() for p in parameters)
 
         if n_params == 0 or n_params > 1e9:
             return
 
-        norm = torch.norm(all_params)
-
-        # Convert to CPU for plotting
-        all_params_cpu = all_params.cpu().float().numpy()
-
-        # Plot histogram
-        plt.figure()
-        plt.hist(all_params_cpu, bins=bins, density=False, color = color)
-        plt.ylim(0, ymax_f * len(all_params_cpu.flatten()))
-        plt.xlim(min_val, max_val)
-        plt.xlabel('Weight Value')
-        plt.ylabel('Count')
-        plt.title(f'{name} (std: {np.std(all_params_cpu):.5f}, norm: {norm:.3f}, step {step:03d})')
-        plt.savefig(f"{checkpoint_dir}/{name}_hist_{step:04d}.png")
-        plt.close()
+        # Stream over the parameters on their device instead of concatenating everything and copying it to the cpu:
+        # first pass: value range (same bin edges as plt.hist) + sum and L2 norm per tensor (for std and norm)
+        # (the reductions accumulate in fp32 via dtype=..., fp16 / bf16 tensors are never upcast as a whole)
+        # (parameters can live on different devices, e.g. offloaded text encoders: the per-tensor results are gathered on the first one)
+        device = parameters[0].device
+        stats = torch.stack([torch.stack([p.min().float(), p.max().float(), p.sum(dtype=torch.float32), torch.linalg.vector_norm(p, dtype=torch.float32)]).to(device) for p in parameters])
+        p_min, p_max, p_sum = stats[:, 0].min(), stats[:, 1].max(), stats[:, 2].double().sum()
+        norm = torch.linalg.vector_norm(stats[:, 3].double())
+        p_min, p_max, p_sum, norm = [v.item() for v in (p_min, p_max, p_sum, norm)]
+        if p_min == p_max:
+            p_min, p_max = p_min - 0.5, p_max + 0.5
+
+        p_sq_sum = norm ** 2
+        std = max(p_sq_sum / n_params - (p_sum / n_params) ** 2, 0.0) ** 0.5
+
+        # second pass: accumulate the bin counts, only these (bins values) are moved to the cpu.
+        # For huge parameter sets, a random subsample of ~max_hist_samples values gives the same histogram shape
+        # (counts are rescaled to n_params, the stats above always use all values):
+        sample_f = min(1.0, max_hist_samples / n_params)
+        counts = torch.zeros(bins, device=device)
+        n_sampled = 0
+        for p in parameters:
+            if sample_f < 1.0:
+                p = p[torch.randint(0, p.numel(), (max(1, int(p.numel() * sample_f)),), device=p.device)]
+            # histc needs fp32 input, cast in chunks so the extra memory stays bounded to _HIST_CHUNK_SIZE values:
+            for chunk in p.split(_HIST_CHUNK_SIZE):
+                counts += torch.histc(chunk.float(), bins=bins, min=p_min, max=p_max).to(device)
+            n_sampled += p.numel()
+        counts = (counts * (n_params / n_sampled)).cpu().numpy()
+        bin_edges = np.linspace(p_min, p_max, bins + 1)
+
+        # Only the (small) cpu arrays are handed to the plotting thread:
+        _pending_plots.append(_PLOT_POOL.submit(
+            _draw_hist, counts, bin_edges, n_params, std, norm, step, checkpoint_dir, name, min_val, max_val, ymax_f, color
+        ))
     except:
         print(f'Error plotting {name} histogram')
 
+def _draw_hist(counts, bin_edges, n_params, std, norm, step, checkpoint_dir, name, min_val, max_val, ymax_f, color):
+    # runs on the plotting thread, errors end up in the future (reported by collect_finished_plots / wait_for_plots)
+    fig, ax = _new_figure()
+    ax.hist(bin_edges[:-1], bins=bin_edges, weights=counts, density=False, color = color)
+    ax.set_ylim(0, ymax_f * n_params)
+    ax.set_xlim(min_val, max_val)
+    ax.set_xlabel('Weight Value')
+    ax.set_ylabel('Count')
+    ax.set_title(f'{name} (std: {std:.5f}, norm: {norm:.3f}, step {step:03d})')
+    # (re)create the dir right before saving, it may have been removed since the plot was submitted:
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    fig.savefig(f"{checkpoint_dir}/{name}_hist_{step:04d}.png")
+
 def plot_curve(value_dict, xlabel, ylabel, title, save_path, log_scale = False, y_lims = None):
-    plt.figure()
+    fig, ax = _new_figure()
     for key in value_dict.keys():
         values = value_dict[key]
-        plt.plot(range(len(values)), values, label=key)
+        ax.plot(range(len(values)), values, label=key)
 
     if log_scale:
-        plt.yscale('log')  # Set y-axis to log scale
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
+        ax.set_yscale('log')  # Set y-axis to log scale
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
     if y_lims is not None:
-        plt.ylim(y_lims[0], y_lims[1])
-    plt.title(title)
-    plt.legend()
-    plt.savefig(save_path)
-    plt.close()
+        ax.set_ylim(y_lims[0], y_lims[1])
+    ax.set_title(title)
+    ax.legend()
+    fig.savefig(save_path)
 
 # plot the learning rates:
 def plot_lrs(learning_rate_dict, save_path='learning_rates.png'):
-    plt.figure()
+    fig, ax = _new_figure()
     for key in learning_rate_dict.keys():
         lrs = learning_rate_dict[key]
         if len(lrs) == 0:
             continue
-        plt.plot(range(len(lrs)), lrs, label=key)
-    plt.yscale('log')  # Set y-axis to log scale
-    plt.ylim(1e-6, 3e-3)
-    plt.xlabel('Step')
-    plt.ylabel('Learning Rate')
-    plt.title('Learning Rate Curves')
-    plt.legend()
-    plt.savefig(save_path)
-    plt.close()
+        ax.plot(range(len(lrs)), lrs, label=key)
+    ax.set_yscale('log')  # Set y-axis to log scale
+    ax.set_ylim(1e-6, 3e-3)
+    ax.set_xlabel('Step')
+    ax.set_ylabel('Learning Rate')
+    ax.set_title('Learning Rate Curves')
+    ax.legend()
+    fig.savefig(save_path)
 
 # plot the learning rates:
 def plot_grad_norms(grad_norms, save_path='grad_norms.png'):
-    plt.figure()
-    plt.plot(range(len(grad_norms['unet'])), grad_norms['unet'], label='unet')
-
-    for i in range(2):
-        try:
-            plt.plot(range(len(grad_norms[f'text_encoder_{i}'])), grad_norms[f'text_encoder_{i}'], label=f'text_encoder_{i}')
-        except:
-            pass
-
-    plt.yscale('log')  # Set y-axis to log scale
-    plt.ylim(1e-6, 100.0)
-    plt.xlabel('Step')
-    plt.ylabel('Grad Norm')
-    plt.title('Gradient Norms')
-    plt.legend()
-    plt.savefig(save_path)
-    plt.close()
+    fig, ax = _new_figure()
+    for key in ('unet', 'text_encoder_0', 'text_encoder_1'):
+        values = grad_norms.get(key)
+        if values:
+            ax.plot(np.asarray(values, dtype=np.float32), label=key)
+
+    ax.set_yscale('log')  # Set y-axis to log scale
+    ax.set_ylim(1e-6, 100.0)
+    ax.set_xlabel('Step')
+    ax.set_ylabel('Grad Norm')
+    ax.set_title('Gradient Norms')
+    ax.legend()
+    fig.savefig(save_path)
 
 def plot_token_stds(token_std_dict, save_path='token_stds.png', target_value_dict = {}):
-    plt.figure()
+    fig, ax = _new_figure()
     anchor_values = []
     for key in token_std_dict.keys():
         tokenizer_i_token_stds = token_std_dict[key]
-        for i in range(len(tokenizer_i_token_stds)):
-            stds = tokenizer_i_token_stds[i]
-            if len(stds) == 0:
-                continue
-            anchor_values.append(stds[0])
-            encoder_index = int(key.split('_')[-1])
-            plt.plot(range(len(stds)), stds, label=f'{key}_tok_{i}', linestyle='dashed' if encoder_index > 0 else 'solid')
-
-    plt.xlabel('Step')
-    plt.ylabel('Token Embedding Std')
-    centre_value = 0.013
-    up_f, down_f = 1.4, 1.3
-    try:
-        plt.ylim(centre_value/down_f, centre_value*up_f)
-    except:
-        pass
+        encoder_index = int(key.split('_')[-1])
+        linestyle = 'dashed' if encoder_index > 0 else 'solid'
+        all_stds = [(i, np.asarray(tokenizer_i_token_stds[i], dtype=np.float32)) for i in range(len(tokenizer_i_token_stds)) if len(tokenizer_i_token_stds[i])]
+        if len(all_stds) == 0:
+            continue
+        anchor_values.extend(stds[0] for _, stds in all_stds)
+
+        if len({len(stds) for _, stds in all_stds}) == 1:
+            # all tokens have the same number of steps: draw them with a single plot call on a (n_steps, n_tokens) array
+            lines = ax.plot(np.stack([stds for _, stds in all_stds], axis=1), linestyle=linestyle)
+            for line, (i, _) in zip(lines, all_stds):
+                line.set_label(f'{key}_tok_{i}')
+        else:
+            for i, stds in all_stds:
+                ax.plot(range(len(stds)), stds, label=f'{key}_tok_{i}', linestyle=linestyle)
+
+    ax.set_xlabel('Step')
+    ax.set_ylabel('Token Embedding Std')
+    if len(anchor_values) > 0:
+        # centre the y-axis around the starting std of the tokens:
+        centre_value = float(np.mean(anchor_values))
+        up_f, down_f = 1.4, 1.3
+        ax.set_ylim(centre_value/down_f, centre_value*up_f)
     
     # Plotting target values as horizontal lines
     for label, value in target_value_dict.items():
-        plt.axhline(y=value, color='r', linestyle='-' if '0' in label else '--', label=label)
-        plt.text(0, value, label, ha='left', va='center')
-
-    plt.title('Token Embedding Std')
-    plt.legend()
-    plt.savefig(save_path)
-    plt.close()
+        ax.axhline(y=value, color='r', linestyle='-' if '0' in label else '--', label=label)
+        ax.text(0, value, label, ha='left', va='center')
+
+    ax.set_title('Token Embedding Std')
+    ax.legend()
+    fig.savefig(save_path)
+
+def to_float_list(values):
+    """
+    Convert a list of (possibly GPU) scalar tensors into python floats using a single device sync.
+    Training losses are stored as detached tensors so that the training step never has to call .item()
+    """
+    if len(values) == 0 or not torch.is_tensor(values[0]):
+        return list(values)
+    device = values[0].device
+    return torch.stack([v.detach().float().to(device) for v in values]).cpu().tolist()
 
 from scipy.signal import savgol_filter
 def plot_loss(loss_dict, save_path='losses.png', window_length=31, polyorder=3, default_color='gray'):
+    loss_dict = {key: to_float_list(values) for key, values in loss_dict.items()}
     colormap = {'img_loss': 'blue', 'tot_loss': 'green', 'covariance_tok_reg_loss': 'orange', 'concept_description_loss': 'red', 'token_attention_loss': 'purple'}
     values_to_add_to_title = ['concept_description_loss', 'covariance_tok_reg_loss']
     plot_smoothed = ['img_loss']
 
-    plt.figure(figsize=(8, 5))
+    fig, ax = _new_figure(figsize=(8, 5))
     
     for key, losses in loss_dict.items():
         if key == 'tot_loss':
             continue
 
-        losses = np.array(losses)
-        
         if len(losses) < window_length:
             continue
 
+        # one float32 array per curve, reused for smoothing, normalizing and plotting:
+        losses = np.asarray(losses, dtype=np.float32)
+
         if key in plot_smoothed:
             losses = savgol_filter(losses, window_length, polyorder)
             label = f'Smoothed {key}'
@@ -260,9 +409,9 @@ def plot_loss(loss_dict, save_path='losses.png', window_length=31, polyorder=3,
             label = key
             linestyle = 'solid'
 
-        plot_losses = losses / np.max(losses)
+        plot_losses = losses / losses.max()
         color = colormap.get(key, default_color)  # Use the default color if the key is not in the colormap
-        plt.plot(plot_losses, label=label, color=color, linestyle=linestyle)
+        ax.plot(plot_losses, label=label, color=color, linestyle=linestyle)
 
     # Create the title:
     title = 'Loss values:'
@@ -271,10 +420,9 @@ def plot_loss(loss_dict, save_path='losses.png', window_length=31, polyorder=3,
             if loss_dict[key]:
                 title += f' {key}: {loss_dict[key][-1]:.3f}'
 
-    plt.title(title)
-    plt.xlabel('Optimizer Step')
-    plt.ylabel('Training Losses')
-    plt.ylim(0, 1.1)  # Adjust the y-axis limits for normalized data
-    plt.legend(loc='lower left')
-    plt.savefig(save_path)
-    plt.close()
\ No newline at end of file
+    ax.set_title(title)
+    ax.set_xlabel('Optimizer Step')
+    ax.set_ylabel('Training Losses')
+    ax.set_ylim(0, 1.1)  # Adjust the y-axis limits for normalized data
+    ax.legend(loc='lower left')
+    fig.savefig(save_path)